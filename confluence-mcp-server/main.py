@@ -1,22 +1,35 @@
 import os
+import asyncio
 import base64
+import random
 import json
+import time
+from datetime import datetime
 from typing import List, Dict, Optional, Union
-import logging as logger
+import logging
 
-import requests
-from requests.auth import HTTPBasicAuth
+import httpx
+from importlib.util import find_spec
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 import contextlib
+from functools import partial
 
 from mcp.server.fastmcp import FastMCP
 
 # --------------------------------------------------------------------
 # Logging setup
 # --------------------------------------------------------------------
-logger.basicConfig(level=logger.INFO)
+# WARNING by default so per-request INFO lines (httpx logs every call) aren't
+# formatted on the hot path; set LOG_LEVEL=INFO/DEBUG when troubleshooting
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # --------------------------------------------------------------------
 # Confluence client configuration (with PAT)
@@ -36,21 +49,170 @@ HEADERS = {
     "Authorization": f"Bearer {CONFLUENCE_PAT}",
 }
 
-def cf_request(method: str, url: str, **kwargs) -> Dict:
-    resp = requests.request(method, url, headers=HEADERS, **kwargs)
-    if not resp.ok:
+# HTTP/2 lets concurrent calls multiplex over one connection per host; it needs
+# the h2 package (httpx[http2]), so fall back to HTTP/1.1 keep-alive without it
+HTTP2 = find_spec("h2") is not None
+
+# Shared async client: keep-alive/HTTP2 connections are reused across tool calls
+HTTP = httpx.AsyncClient(
+    base_url=API_BASE,
+    headers=HEADERS,
+    http2=HTTP2,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50")),
+        # httpx drops idle sockets after 5s by default; tool calls are often further apart
+        keepalive_expiry=60.0,
+    ),
+    timeout=30.0,
+)
+
+# Retry policy for transient upstream failures
+MAX_RETRIES = 5
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+def retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying `resp`, or None if it shouldn't be retried.
+    Honors Retry-After, otherwise exponential backoff with full jitter (base 1s, cap 30s).
+    A 502/504 may hide a completed write, so those are only retried for idempotent methods.
+    """
+    status = resp.status_code
+    if status in (502, 504):
+        if resp.request.method not in IDEMPOTENT_METHODS:
+            return None
+    elif status not in (429, 503):
+        return None
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        # Don't park a tool call for minutes; surface long waits as errors instead
+        return float(retry_after) if int(retry_after) <= 60 else None
+    return random.uniform(0, min(30.0, 2.0 ** attempt))
+
+# Client-side rate governor: cap our own request rate and, once Atlassian's
+# X-RateLimit-Remaining runs low, spread what's left until the reset
+RATE_LIMITER = AsyncLimiter(int(os.getenv("CONFLUENCE_RATE_LIMIT_PER_MINUTE", "100")), 60)
+RATE_LIMIT_LOW_WATER = 10
+RATE_STATS = {"requests": 0, "rate_limited": 0, "throttled": 0}
+rate_limit_resume_at = 0.0  # monotonic time before which new requests wait
+
+def reset_timestamp(value: str) -> Optional[float]:
+    """X-RateLimit-Reset as epoch seconds; Atlassian sends ISO 8601, others epoch."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+def note_rate_limit(resp: httpx.Response):
+    global rate_limit_resume_at
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    reset = reset_timestamp(resp.headers.get("X-RateLimit-Reset", ""))
+    if remaining is None or reset is None or int(remaining) > RATE_LIMIT_LOW_WATER:
+        return
+    pause = min(60.0, max(0.0, reset - time.time()) / (int(remaining) + 1))
+    rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + pause)
+    RATE_STATS["throttled"] += 1
+
+async def send_with_retry(request: httpx.Request) -> httpx.Response:
+    for attempt in range(MAX_RETRIES + 1):
+        wait = rate_limit_resume_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with RATE_LIMITER:
+            resp = await HTTP.send(request)
+        RATE_STATS["requests"] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s -> %s (%s)", request.method, request.url, resp.status_code, resp.http_version)
+        if resp.status_code == 429:
+            RATE_STATS["rate_limited"] += 1
+        note_rate_limit(resp)
+        delay = retry_delay(resp, attempt)
+        if delay is None or attempt == MAX_RETRIES:
+            return resp
+        logger.warning("Confluence %s %s returned %s, retrying in %.1fs", request.method, request.url, resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+class ConfluenceAPIError(RuntimeError):
+    def __init__(self, status_code: int, detail):
+        super().__init__(f"Confluence API error {status_code}: {detail}")
+        self.status_code = status_code
+
+# GET response cache keyed by URL. Entries are [fetched_at, etag, body, size]; stale
+# entries are kept (up to an hour) so they can be revalidated with If-None-Match.
+# Freshness is judged against each call's own cache_ttl, so cache_ttl=0 always
+# goes upstream (as a cheap conditional GET when an ETag is cached).
+CACHE_TTL = 60
+# Bounded by response bytes, not entry count: expanded body.storage pages can run
+# to megabytes and parse to several times that. Responses over a sixteenth of
+# the budget aren't cached.
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE = TTLCache(maxsize=CACHE_MAX_BYTES, ttl=3600, getsizeof=lambda entry: entry[-1])
+
+def expire_cache():
+    """Mark every cached GET stale so reads after a write are revalidated."""
+    for entry in CACHE.values():
+        entry[0] = float("-inf")
+
+def cached_title(path: str, version: int) -> Optional[str]:
+    """
+    Title from a cached GET of `path` (any expand params) that was read at exactly
+    `version`; a body from any other version may carry an outdated title.
+    """
+    base = str(HTTP.build_request("GET", path).url)
+    for key, entry in list(CACHE.items()):
+        body = entry[2]
+        if key.split("?", 1)[0] != base or not isinstance(body, dict):
+            continue
+        if body.get("version", {}).get("number") == version and body.get("title"):
+            return body["title"]
+    return None
+
+async def cf_request(method: str, path: str, cache_ttl: int = CACHE_TTL, **kwargs) -> Dict:
+    if "json" in kwargs:
+        # Serialize payloads (storage bodies can be large) with orjson; the
+        # client already sends Content-Type: application/json
+        kwargs["content"] = orjson.dumps(kwargs.pop("json"))
+    request = HTTP.build_request(method, path, **kwargs)
+    key = str(request.url)
+    cached = CACHE.get(key) if method == "GET" else None
+    if cached:
+        if time.monotonic() - cached[0] < cache_ttl:
+            return cached[2]
+        if cached[1]:
+            request.headers["If-None-Match"] = cached[1]
+    resp = await send_with_retry(request)
+    if resp.status_code == 304 and cached:
+        cached[0] = time.monotonic()
+        CACHE[key] = cached
+        return cached[2]
+    if not resp.is_success:
         # Try to provide meaningful error context
         try:
-            detail = resp.json()
-        except Exception:
+            detail = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
             detail = resp.text
-        raise RuntimeError(f"Confluence API error {resp.status_code}: {detail}")
-    if resp.text:
+        raise ConfluenceAPIError(resp.status_code, detail)
+    body = {}
+    if resp.content:
         try:
-            return resp.json()
-        except Exception:
-            return {"raw": resp.text}
-    return {}
+            body = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            body = {"raw": resp.text}
+    if method != "GET":
+        expire_cache()
+    elif "no-store" not in resp.headers.get("Cache-Control", "") and len(resp.content) <= CACHE_MAX_BYTES // 16:
+        CACHE[key] = [time.monotonic(), resp.headers.get("ETag"), body, len(resp.content)]
+    return body
+
+# Method-bound entry points so tools call the helper without passing the verb
+cf_get = partial(cf_request, "GET")
+cf_post = partial(cf_request, "POST")
+cf_put = partial(cf_request, "PUT")
+cf_delete = partial(cf_request, "DELETE")
 
 
 # Helper to format Confluence storage body
@@ -72,7 +234,7 @@ mcp = FastMCP("ConfluenceMCPServer", stateless_http=True, json_response=True)
 # Tools
 # --------------------------------------------------------------------
 @mcp.tool()
-def confluence_create_page(space_key: str, title: str, html_content: str, parent_page_id: Optional[str] = None) -> Dict:
+async def confluence_create_page(space_key: str, title: str, html_content: str, parent_page_id: Optional[str] = None) -> Dict:
     """
     Create a new Confluence page in the given space. Optionally set a parent page (to create a child page).
     """
@@ -84,8 +246,8 @@ def confluence_create_page(space_key: str, title: str, html_content: str, parent
     }
     if parent_page_id:
         data["ancestors"] = [{"id": str(parent_page_id)}]
-    url = f"{API_BASE}/content"
-    created = cf_request("POST", url, json=data)
+    url = "/content"
+    created = await cf_post(url, json=data)
     return {
         "message": "Page created",
         "id": created.get("id"),
@@ -94,42 +256,65 @@ def confluence_create_page(space_key: str, title: str, html_content: str, parent
     }
 
 @mcp.tool()
-def confluence_get_page(page_id: Optional[str] = None, title: Optional[str] = None, space_key: Optional[str] = None, expand_body: bool = True) -> Dict:
+async def confluence_get_page(page_id: Optional[str] = None, title: Optional[str] = None, space_key: Optional[str] = None, expand_body: bool = True, cache_ttl: int = CACHE_TTL) -> Dict:
     """
     Get a page by ID, or by title + space_key. If expand_body is True, returns storage HTML content.
+    Results are cached for cache_ttl seconds; pass 0 to force a fresh read.
     """
     expand = "body.storage,version" if expand_body else "version"
     if page_id:
-        url = f"{API_BASE}/content/{page_id}?expand={expand}"
-        return cf_request("GET", url)
+        return await cf_get(f"/content/{page_id}", params={"expand": expand}, cache_ttl=cache_ttl)
     if not title or not space_key:
         raise RuntimeError("Provide either page_id OR (title and space_key).")
-    url = f"{API_BASE}/content?title={requests.utils.quote(title)}&spaceKey={requests.utils.quote(space_key)}&expand={expand}"
-    result = cf_request("GET", url)
+    params = {"title": title, "spaceKey": space_key, "expand": expand}
+    result = await cf_get("/content", params=params, cache_ttl=cache_ttl)
     results = result.get("results", [])
     if not results:
         return {"message": "No page found", "results": []}
     return results[0]
 
 @mcp.tool()
-def confluence_update_page(page_id: str, new_title: Optional[str] = None, new_html_content: Optional[str] = None, minor_edit: bool = False) -> Dict:
+async def confluence_update_page(page_id: str, new_title: Optional[str] = None, new_html_content: Optional[str] = None, minor_edit: bool = False, if_match_version: Optional[int] = None) -> Dict:
     """
     Update an existing page's title and/or storage body. Automatically increments version.
+    Pass if_match_version (the version number you last read) to skip the version lookup;
+    if the page changed since, the current version is fetched and the update retried once.
     """
-    # Get current version
-    current = cf_request("GET", f"{API_BASE}/content/{page_id}?expand=version")
-    version = current.get("version", {}).get("number")
+    url = f"/content/{page_id}"
+    current: Dict = {}
+    if if_match_version is None:
+        current = await cf_get(url, params={"expand": "version"}, cache_ttl=0)
+    elif new_title is None:
+        # Only the existing title is needed; a cached read of the same version
+        # has it, whatever that read expanded
+        title = cached_title(url, if_match_version)
+        current = {"title": title} if title else await cf_get(url, params={"expand": "version"})
+    version = if_match_version or current.get("version", {}).get("number")
     if not version:
         raise RuntimeError("Could not determine current version number for the page.")
-    payload: Dict[str, Union[str, Dict]] = {
-        "id": str(page_id),
-        "type": "page",
-        "title": new_title or current.get("title"),
-        "version": {"number": version + 1, "minorEdit": minor_edit}
-    }
-    if new_html_content is not None:
-        payload["body"] = storage_body_html(new_html_content)
-    updated = cf_request("PUT", f"{API_BASE}/content/{page_id}", json=payload)
+
+    def build_payload(version: int, title: Optional[str]) -> Dict:
+        payload: Dict[str, Union[str, Dict]] = {
+            "id": str(page_id),
+            "type": "page",
+            "title": new_title or title,
+            "version": {"number": version + 1, "minorEdit": minor_edit}
+        }
+        if new_html_content is not None:
+            payload["body"] = storage_body_html(new_html_content)
+        return payload
+
+    try:
+        updated = await cf_put(url, json=build_payload(version, current.get("title")))
+    except ConfluenceAPIError as exc:
+        if exc.status_code != 409:
+            raise
+        # Version conflict: someone saved in between, so refresh once and retry
+        current = await cf_get(url, params={"expand": "version"}, cache_ttl=0)
+        version = current.get("version", {}).get("number")
+        if not version:
+            raise RuntimeError("Could not determine current version number for the page.")
+        updated = await cf_put(url, json=build_payload(version, current.get("title")))
     return {
         "message": "Page updated",
         "id": updated.get("id"),
@@ -138,85 +323,84 @@ def confluence_update_page(page_id: str, new_title: Optional[str] = None, new_ht
     }
 
 @mcp.tool()
-def confluence_delete_page(page_id: str, status: str = "current") -> Dict:
+async def confluence_delete_page(page_id: str, status: str = "current") -> Dict:
     """
     Delete a Confluence page. status usually 'current' (default). For trash/restore behavior refer to Confluence docs.
     """
-    url = f"{API_BASE}/content/{page_id}?status={requests.utils.quote(status)}"
-    cf_request("DELETE", url)
+    await cf_delete(f"/content/{page_id}", params={"status": status})
     return {"message": f"Page {page_id} deleted", "status": status}
 
 @mcp.tool()
-def confluence_add_comment(page_id: str, html_content: str) -> Dict:
+async def confluence_add_comment(page_id: str, html_content: str) -> Dict:
     """
     Add a comment to a Confluence page (storage HTML).
     """
-    url = f"{API_BASE}/content/{page_id}/child/comment"
+    url = f"/content/{page_id}/child/comment"
     data = {
         "type": "comment",
         "container": {"id": str(page_id), "type": "page"},
         "body": storage_body_html(html_content)
     }
-    created = cf_request("POST", url, json=data)
+    created = await cf_post(url, json=data)
     return {"message": "Comment added", "id": created.get("id")}
 
 @mcp.tool()
-def confluence_get_comments(page_id: str, limit: int = 50, start: int = 0) -> Dict:
+async def confluence_get_comments(page_id: str, limit: int = 50, start: int = 0, cache_ttl: int = CACHE_TTL) -> Dict:
     """
     Get comments for a page. Returns storage HTML for each comment.
+    Results are cached for cache_ttl seconds; pass 0 to force a fresh read.
     """
-    url = f"{API_BASE}/content/{page_id}/child/comment?expand=body.storage,version&limit={limit}&start={start}"
-    return cf_request("GET", url)
+    url = f"/content/{page_id}/child/comment"
+    params = {"expand": "body.storage,version", "limit": limit, "start": start}
+    return await cf_get(url, params=params, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def confluence_add_label(page_id: str, labels: List[str]) -> Dict:
+async def confluence_add_label(page_id: str, labels: List[str]) -> Dict:
     """
     Add one or more labels to a page. Labels will be added with 'global' prefix.
     """
-    url = f"{API_BASE}/content/{page_id}/label"
+    url = f"/content/{page_id}/label"
     payload = [{"prefix": "global", "name": name} for name in labels]
-    resp = cf_request("POST", url, json=payload)
+    resp = await cf_post(url, json=payload)
     return {"message": f"Added {len(labels)} label(s)", "labels": resp}
 
 @mcp.tool()
-def confluence_get_labels(page_id: str, limit: int = 200, start: int = 0) -> Dict:
+async def confluence_get_labels(page_id: str, limit: int = 200, start: int = 0, cache_ttl: int = CACHE_TTL) -> Dict:
     """
     Get labels on a page.
+    Results are cached for cache_ttl seconds; pass 0 to force a fresh read.
     """
-    url = f"{API_BASE}/content/{page_id}/label?limit={limit}&start={start}"
-    return cf_request("GET", url)
+    url = f"/content/{page_id}/label"
+    return await cf_get(url, params={"limit": limit, "start": start}, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def confluence_get_page_children(page_id: str, limit: int = 50, start: int = 0, expand_body: bool = False) -> Dict:
+async def confluence_get_page_children(page_id: str, limit: int = 50, start: int = 0, expand_body: bool = False, cache_ttl: int = CACHE_TTL) -> Dict:
     """
     Get child pages of a page. Optionally expand storage body.
+    Results are cached for cache_ttl seconds; pass 0 to force a fresh read.
     """
     expand = "body.storage,version" if expand_body else "version"
-    url = f"{API_BASE}/content/{page_id}/child/page?expand={expand}&limit={limit}&start={start}"
-    return cf_request("GET", url)
+    url = f"/content/{page_id}/child/page"
+    params = {"expand": expand, "limit": limit, "start": start}
+    return await cf_get(url, params=params, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def confluence_search(query: Optional[str] = None, cql: Optional[str] = None, limit: int = 25, start: int = 0, expand_body: bool = False) -> Dict:
+async def confluence_search(query: Optional[str] = None, cql: Optional[str] = None, limit: int = 25, start: int = 0, expand_body: bool = False, cache_ttl: int = CACHE_TTL) -> Dict:
     """
     Search Confluence. Use either 'query' (simple) or 'cql' (advanced). If expand_body, includes storage content where applicable.
+    Results are cached for cache_ttl seconds; pass 0 to force a fresh read.
     """
-    if cql:
-        expand = "body.storage" if expand_body else None
-        url = f"{API_BASE}/search?cql={requests.utils.quote(cql)}&limit={limit}&start={start}"
-        if expand:
-            url += f"&expand={expand}"
-        return cf_request("GET", url)
-
-    if query:
-        # Simple search: use CQL under the hood (title, text)
-        safe = requests.utils.quote(query)
-        cql_expr = f'text ~ "{safe}" OR title ~ "{safe}"'
-        url = f"{API_BASE}/search?cql={cql_expr}&limit={limit}&start={start}"
-        if expand_body:
-            url += "&expand=body.storage"
-        return cf_request("GET", url)
-
-    raise RuntimeError("Provide either 'query' or 'cql' for search.")
+    if not cql:
+        if not query:
+            raise RuntimeError("Provide either 'query' or 'cql' for search.")
+        # Simple search: use CQL under the hood (title, text). Only CQL string
+        # escaping happens here; httpx URL-encodes the params once.
+        literal = query.replace("\\", "\\\\").replace('"', '\\"')
+        cql = f'text ~ "{literal}" OR title ~ "{literal}"'
+    params = {"cql": cql, "limit": limit, "start": start}
+    if expand_body:
+        params["expand"] = "body.storage"
+    return await cf_get("/search", params=params, cache_ttl=cache_ttl)
 
 # --------------------------------------------------------------------
 # FastAPI wrapper with lifespan to start MCP
@@ -228,6 +412,8 @@ async def lifespan(_: FastAPI):
     async with contextlib.AsyncExitStack() as stack:
         # Start MCP session manager so task group is initialized
         await stack.enter_async_context(mcp.session_manager.run())
+        # Release pooled connections on shutdown
+        stack.push_async_callback(HTTP.aclose)
         yield
 
 app = FastAPI(lifespan=lifespan)
@@ -236,5 +422,11 @@ app = FastAPI(lifespan=lifespan)
 def healthz():
     return {"status": "ok"}
 
-# Mount MCP server at "/"
-app.mount("/", mcp_app)
+@app.get("/metrics")
+def metrics():
+    """Upstream request counters, for watching the 429 rate."""
+    return RATE_STATS
+
+# Serve the MCP endpoint (/mcp) from this app's router rather than a mounted
+# sub-app, so requests resolve in a single routing pass
+app.router.routes.extend(mcp_app.routes)
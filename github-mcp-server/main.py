@@ -1,11 +1,20 @@
 import os
+import asyncio
 import base64
-import requests
+import random
+import time
+import httpx
+from importlib.util import find_spec
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from typing import List, Dict, Optional
-import logging as logger
-from fastapi import FastAPI, Request, HTTPException
+import logging
+from fastapi import FastAPI, HTTPException
+from starlette.datastructures import Headers
 from contextlib import asynccontextmanager
 import contextlib
+from contextvars import ContextVar
 
 from mcp.server.fastmcp import FastMCP
 
@@ -13,7 +22,12 @@ from mcp.server.fastmcp import FastMCP
 # --------------------------------------------------------------------
 # Logging setup
 # --------------------------------------------------------------------
-logger.basicConfig(level=logger.INFO)
+# WARNING by default so per-request INFO lines (httpx logs every call) aren't
+# formatted on the hot path; set LOG_LEVEL=INFO/DEBUG when troubleshooting
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # --------------------------------------------------------------------
 # GitHub client helper
@@ -28,16 +42,142 @@ HEADERS = {
     "Accept": "application/vnd.github.v3+json"
 }
 
-def github_request(method: str, url: str, **kwargs):
-    resp = requests.request(method, url, headers=HEADERS, **kwargs)
-    if not resp.ok:
+# HTTP/2 lets concurrent calls multiplex over one connection per host; it needs
+# the h2 package (httpx[http2]), so fall back to HTTP/1.1 keep-alive without it
+HTTP2 = find_spec("h2") is not None
+
+# Shared async client: keep-alive/HTTP2 connections are reused across tool calls
+HTTP = httpx.AsyncClient(
+    base_url=BASE_URL,
+    headers=HEADERS,
+    http2=HTTP2,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50")),
+        # httpx drops idle sockets after 5s by default; tool calls are often further apart
+        keepalive_expiry=60.0,
+    ),
+    timeout=30.0,
+)
+
+# Caps concurrent blob uploads so fan-out doesn't trip GitHub's abuse detection
+BLOB_UPLOADS = asyncio.Semaphore(8)
+
+# Retry policy for transient upstream failures
+MAX_RETRIES = 5
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+def retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying `resp`, or None if it shouldn't be retried.
+    Honors Retry-After, otherwise exponential backoff with full jitter (base 1s, cap 30s).
+    A 502/504 may hide a completed write, so those are only retried for idempotent methods.
+    """
+    status = resp.status_code
+    if status in (502, 504):
+        if resp.request.method not in IDEMPOTENT_METHODS:
+            return None
+    elif status not in (429, 503) and not (status == 403 and "Retry-After" in resp.headers):
+        return None
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        # Don't park a tool call for minutes; surface long waits as errors instead
+        return float(retry_after) if int(retry_after) <= 60 else None
+    return random.uniform(0, min(30.0, 2.0 ** attempt))
+
+# Client-side rate governor: stay under GitHub's REST budget (5000/h, ~80/min)
+# and, once X-RateLimit-Remaining runs low, spread what's left until the reset
+RATE_LIMITER = AsyncLimiter(int(os.getenv("GITHUB_RATE_LIMIT_PER_MINUTE", "80")), 60)
+RATE_LIMIT_LOW_WATER = 50
+RATE_STATS = {"requests": 0, "rate_limited": 0, "throttled": 0}
+rate_limit_resume_at = 0.0  # monotonic time before which new requests wait
+
+def note_rate_limit(resp: httpx.Response):
+    global rate_limit_resume_at
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    reset = resp.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None or int(remaining) > RATE_LIMIT_LOW_WATER:
+        return
+    pause = min(60.0, max(0.0, float(reset) - time.time()) / (int(remaining) + 1))
+    rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + pause)
+    RATE_STATS["throttled"] += 1
+
+async def send_with_retry(request: httpx.Request) -> httpx.Response:
+    for attempt in range(MAX_RETRIES + 1):
+        wait = rate_limit_resume_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with RATE_LIMITER:
+            resp = await HTTP.send(request)
+        RATE_STATS["requests"] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s -> %s (%s)", request.method, request.url, resp.status_code, resp.http_version)
+        if resp.status_code == 429:
+            RATE_STATS["rate_limited"] += 1
+        note_rate_limit(resp)
+        delay = retry_delay(resp, attempt)
+        if delay is None or attempt == MAX_RETRIES:
+            return resp
+        logger.warning("GitHub %s %s returned %s, retrying in %.1fs", request.method, request.url, resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+# GET response cache keyed by URL. Entries are [fetched_at, etag, body, pinned, size]; stale
+# entries are kept (up to an hour) so they can be revalidated with If-None-Match.
+# Freshness is judged against each call's own cache_ttl, so cache_ttl=0 always
+# goes upstream (as a cheap conditional GET when an ETag is cached).
+# Pinned entries are SHA-addressed (immutable) objects that writes never invalidate.
+CACHE_TTL = 60
+# Bounded by response bytes, not entry count: contents payloads reach 1 MB and
+# parse to several times that. Responses over a sixteenth of the budget aren't cached.
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE = TTLCache(maxsize=CACHE_MAX_BYTES, ttl=3600, getsizeof=lambda entry: entry[-1])
+
+def expire_cache():
+    """Mark every cached GET stale so reads after a write are revalidated."""
+    for entry in CACHE.values():
+        if not entry[3]:
+            entry[0] = float("-inf")
+
+async def github_request(method: str, path: str, cache_ttl: int = CACHE_TTL, pinned: bool = False, **kwargs):
+    request = HTTP.build_request(method, path, **kwargs)
+    key = str(request.url)
+    cached = CACHE.get(key) if method == "GET" else None
+    if cached:
+        if time.monotonic() - cached[0] < cache_ttl:
+            return cached[2]
+        if cached[1]:
+            request.headers["If-None-Match"] = cached[1]
+    resp = await send_with_retry(request)
+    if resp.status_code == 304 and cached:
+        cached[0] = time.monotonic()
+        CACHE[key] = cached
+        return cached[2]
+    if not resp.is_success:
         raise RuntimeError(f"GitHub API error {resp.status_code}: {resp.text}")
-    return resp.json() if resp.text else {}
+    body = orjson.loads(resp.content) if resp.content else {}
+    if method != "GET":
+        expire_cache()
+    elif "no-store" not in resp.headers.get("Cache-Control", "") and len(resp.content) <= CACHE_MAX_BYTES // 16:
+        CACHE[key] = [time.monotonic(), resp.headers.get("ETag"), body, pinned, len(resp.content)]
+    return body
+
+
+# Set once per HTTP request by ReadonlyMiddleware and read by the write tools
+READONLY: ContextVar[bool] = ContextVar("readonly", default=False)
 
+class ReadonlyMiddleware:
+    """Evaluate the X-MCP-Readonly header once per request, before any tool runs."""
+    def __init__(self, app):
+        self.app = app
 
-def check_readonly(request: Request):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            READONLY.set(Headers(scope=scope).get("x-mcp-readonly", "").lower() == "true")
+        await self.app(scope, receive, send)
+
+def check_readonly():
     """Raise if MCP client requested readonly mode."""
-    if request.headers.get("X-MCP-Readonly", "").lower() == "true":
+    if READONLY.get():
         raise HTTPException(status_code=403, detail="Readonly mode enforced")
 
 # --------------------------------------------------------------------
@@ -50,75 +190,86 @@ mcp = FastMCP("GitHubMCPServer", stateless_http=True, json_response=True)
 # Tools
 # --------------------------------------------------------------------
 @mcp.tool()
-def create_branch(owner: str, repo: str, new_branch: str, base_branch: str = "main", request: Request = None) -> Dict:
-    check_readonly(request)
-    ref_url = f"{BASE_URL}/repos/{owner}/{repo}/git/ref/heads/{base_branch}"
-    ref_data = github_request("GET", ref_url)
+async def create_branch(owner: str, repo: str, new_branch: str, base_branch: str = "main") -> Dict:
+    check_readonly()
+    ref_url = f"/repos/{owner}/{repo}/git/ref/heads/{base_branch}"
+    # Refs move, so always revalidate; an unchanged ref comes back as a cheap 304
+    ref_data = await github_request("GET", ref_url, cache_ttl=0)
     sha = ref_data["object"]["sha"]
 
-    create_url = f"{BASE_URL}/repos/{owner}/{repo}/git/refs"
-    resp = github_request("POST", create_url, json={"ref": f"refs/heads/{new_branch}", "sha": sha})
+    create_url = f"/repos/{owner}/{repo}/git/refs"
+    resp = await github_request("POST", create_url, json={"ref": f"refs/heads/{new_branch}", "sha": sha})
     return {"message": f"Branch '{new_branch}' created", "ref": resp}
 
 @mcp.tool()
-def create_or_update_file(owner: str, repo: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None, request: Request = None) -> Dict:
-    check_readonly(request)
-    encoded = base64.b64encode(content.encode()).decode()
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{path}"
-    payload = {"message": message, "content": encoded, "branch": branch}
+async def create_or_update_file(owner: str, repo: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None) -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/contents/{path}"
+    payload = {"message": message, "branch": branch}
     if sha:
         payload["sha"] = sha
-    resp = github_request("PUT", url, json=payload)
+    # Base64 output is JSON-safe, so splice the encoded bytes straight into the
+    # body rather than decoding them to str for the serializer to re-encode
+    encoded = base64.b64encode(content.encode("utf-8"))
+    data = orjson.dumps(payload)[:-1] + b',"content":"' + encoded + b'"}'
+    resp = await github_request("PUT", url, content=data, headers={"Content-Type": "application/json"})
     return {"message": f"File '{path}' updated", "commit": resp.get("commit")}
 
 @mcp.tool()
-def get_contents(owner: str, repo: str, path: str, ref: str = "main") -> Dict:
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{path}?ref={ref}"
-    return github_request("GET", url)
+async def get_contents(owner: str, repo: str, path: str, ref: str = "main", cache_ttl: int = CACHE_TTL) -> Dict:
+    url = f"/repos/{owner}/{repo}/contents/{path}?ref={ref}"
+    return await github_request("GET", url, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def create_pull_request(owner: str, repo: str, title: str, head: str, base: str = "main", body: str = "", request: Request = None) -> Dict:
-    check_readonly(request)
-    url = f"{BASE_URL}/repos/{owner}/{repo}/pulls"
-    resp = github_request("POST", url, json={"title": title, "head": head, "base": base, "body": body})
+async def create_pull_request(owner: str, repo: str, title: str, head: str, base: str = "main", body: str = "") -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/pulls"
+    resp = await github_request("POST", url, json={"title": title, "head": head, "base": base, "body": body})
     return {"message": "PR created", "url": resp.get("html_url"), "number": resp.get("number")}
 
 @mcp.tool()
-def merge_pull_request(owner: str, repo: str, pr_number: int, commit_message: str = "Merging via MCP", request: Request = None) -> Dict:
-    check_readonly(request)
-    url = f"{BASE_URL}/repos/{owner}/{repo}/pulls/{pr_number}/merge"
-    resp = github_request("PUT", url, json={"commit_message": commit_message})
+async def merge_pull_request(owner: str, repo: str, pr_number: int, commit_message: str = "Merging via MCP") -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/pulls/{pr_number}/merge"
+    resp = await github_request("PUT", url, json={"commit_message": commit_message})
     return {"message": f"PR #{pr_number} merged", "sha": resp.get("sha")}
 
 @mcp.tool()
-def push_multiple_files(owner: str, repo: str, branch: str, files: List[Dict[str, str]], message: str, request: Request = None) -> Dict:
-    check_readonly(request)
-    ref_url = f"{BASE_URL}/repos/{owner}/{repo}/git/ref/heads/{branch}"
-    ref_data = github_request("GET", ref_url)
+async def push_multiple_files(owner: str, repo: str, branch: str, files: List[Dict[str, str]], message: str) -> Dict:
+    check_readonly()
+    ref_url = f"/repos/{owner}/{repo}/git/ref/heads/{branch}"
+    # Refs move, so always revalidate; an unchanged ref comes back as a cheap 304
+    ref_data = await github_request("GET", ref_url, cache_ttl=0)
     latest_commit_sha = ref_data["object"]["sha"]
 
-    commit_url = f"{BASE_URL}/repos/{owner}/{repo}/git/commits/{latest_commit_sha}"
-    commit_data = github_request("GET", commit_url)
-    base_tree = commit_data["tree"]["sha"]
+    # Blobs are independent of each other, so upload them concurrently
+    async def upload_blob(f: Dict[str, str]) -> Dict:
+        async with BLOB_UPLOADS:
+            blob = await github_request("POST", f"/repos/{owner}/{repo}/git/blobs", json={"content": f["content"], "encoding": "utf-8"})
+        return {"path": f["path"], "mode": "100644", "type": "blob", "sha": blob["sha"]}
 
-    tree_entries = []
-    for f in files:
-        blob = github_request("POST", f"{BASE_URL}/repos/{owner}/{repo}/git/blobs", json={"content": f["content"], "encoding": "utf-8"})
-        tree_entries.append({"path": f["path"], "mode": "100644", "type": "blob", "sha": blob["sha"]})
+    # Commit objects are immutable, so the base-tree lookup is cached for an hour,
+    # pinned against write invalidation, and overlapped with the blob uploads
+    commit_url = f"/repos/{owner}/{repo}/git/commits/{latest_commit_sha}"
+    commit_data, tree_entries = await asyncio.gather(
+        github_request("GET", commit_url, cache_ttl=3600, pinned=True),
+        asyncio.gather(*(upload_blob(f) for f in files)),
+    )
+    base_tree = commit_data["tree"]["sha"]
 
-    tree = github_request("POST", f"{BASE_URL}/repos/{owner}/{repo}/git/trees", json={"base_tree": base_tree, "tree": tree_entries})
+    tree = await github_request("POST", f"/repos/{owner}/{repo}/git/trees", json={"base_tree": base_tree, "tree": tree_entries})
 
-    commit = github_request("POST", f"{BASE_URL}/repos/{owner}/{repo}/git/commits",
-                            json={"message": message, "tree": tree["sha"], "parents": [latest_commit_sha]})
+    commit = await github_request("POST", f"/repos/{owner}/{repo}/git/commits",
+                                  json={"message": message, "tree": tree["sha"], "parents": [latest_commit_sha]})
 
-    github_request("PATCH", ref_url, json={"sha": commit["sha"]})
+    await github_request("PATCH", ref_url, json={"sha": commit["sha"]})
     return {"message": f"Committed {len(files)} files", "commit": commit}
 
 @mcp.tool()
-def update_pr_branch(owner: str, repo: str, pr_number: int, request: Request = None) -> Dict:
-    check_readonly(request)
-    url = f"{BASE_URL}/repos/{owner}/{repo}/pulls/{pr_number}/update-branch"
-    resp = github_request("PUT", url, json={})
+async def update_pr_branch(owner: str, repo: str, pr_number: int) -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/pulls/{pr_number}/update-branch"
+    resp = await github_request("PUT", url, json={})
     return {"message": f"PR #{pr_number} branch update requested", "response": resp}
 
 # --------------------------------------------------------------------
@@ -131,13 +282,22 @@ async def lifespan(_: FastAPI):
     async with contextlib.AsyncExitStack() as stack:
         # ✅ Start MCP session manager so task group is initialized
         await stack.enter_async_context(mcp.session_manager.run())
+        # Release pooled connections on shutdown
+        stack.push_async_callback(HTTP.aclose)
         yield
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ReadonlyMiddleware)
 
 @app.get("/healthz")
 def healthz():
     return {"status": "ok"}
 
-# Mount MCP server at "/"
-app.mount("/", mcp_app)
+@app.get("/metrics")
+def metrics():
+    """Upstream request counters, for watching the 429 rate."""
+    return RATE_STATS
+
+# Serve the MCP endpoint (/mcp) from this app's router rather than a mounted
+# sub-app, so requests resolve in a single routing pass
+app.router.routes.extend(mcp_app.routes)
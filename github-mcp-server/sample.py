@@ -1,20 +1,36 @@
 import os
+import asyncio
 import base64
 import datetime
-import requests
+import io
+import random
+import re
+import time
+import httpx
+from importlib.util import find_spec
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from typing import List, Dict, Optional
-import logging as logger
-from fastapi import FastAPI, Request, HTTPException
+import logging
+from fastapi import APIRouter, FastAPI, HTTPException
+from starlette.datastructures import Headers
 from fastapi.responses import RedirectResponse, JSONResponse
 from contextlib import asynccontextmanager
 import contextlib
+from contextvars import ContextVar
 
 from mcp.server.fastmcp import FastMCP
 
 # --------------------------------------------------------------------
 # Logging
 # --------------------------------------------------------------------
-logger.basicConfig(level=logger.INFO)
+# WARNING by default so per-request INFO lines (httpx logs every call) aren't
+# formatted on the hot path; set LOG_LEVEL=INFO/DEBUG when troubleshooting
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # --------------------------------------------------------------------
 # Config
@@ -25,37 +41,198 @@ GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "http://localhost:8080/callback")
 
 BASE_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
-user_tokens: Dict[str, str] = {}  # per-user OAuth tokens (demo only)
+# Per-user OAuth tokens (demo only), bounded and expired in line with the token lifetime
+TOKEN_TTL = int(os.getenv("GITHUB_TOKEN_TTL", "3600"))
+user_tokens: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_TTL)
+auth_headers: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_TTL)  # token -> prebuilt headers
+
+# HTTP/2 lets concurrent calls multiplex over one connection per host; it needs
+# the h2 package (httpx[http2]), so fall back to HTTP/1.1 keep-alive without it
+HTTP2 = find_spec("h2") is not None
+
+# Shared async client: keep-alive/HTTP2 connections are reused across requests.
+# Auth headers are per-user, so they are passed on each call.
+HTTP = httpx.AsyncClient(
+    base_url=BASE_URL,
+    http2=HTTP2,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50")),
+        # httpx drops idle sockets after 5s by default; tool calls are often further apart
+        keepalive_expiry=60.0,
+    ),
+    timeout=30.0,
+)
 
 # --------------------------------------------------------------------
 # Auth Helpers
 # --------------------------------------------------------------------
 def get_auth_header(user: Optional[str] = None) -> Dict[str, str]:
-    token = None
-    if user and user in user_tokens:
-        token = user_tokens[user]
-    elif GITHUB_TOKEN:
-        token = GITHUB_TOKEN
+    token = (user_tokens.get(user) if user else None) or GITHUB_TOKEN
     if not token:
         raise HTTPException(status_code=401, detail="No GitHub token available")
-    return {"Authorization": f"Bearer {token}", "Accept": "application/vnd.github.v3+json"}
+    headers = auth_headers.get(token)
+    if headers is None:
+        headers = auth_headers[token] = {"Authorization": f"Bearer {token}", "Accept": "application/vnd.github.v3+json"}
+    return headers
+
+# Retry policy for transient upstream failures
+MAX_RETRIES = 5
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+def retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying `resp`, or None if it shouldn't be retried.
+    Honors Retry-After, otherwise exponential backoff with full jitter (base 1s, cap 30s).
+    A 502/504 may hide a completed write, so those are only retried for idempotent methods.
+    """
+    status = resp.status_code
+    if status in (502, 504):
+        if resp.request.method not in IDEMPOTENT_METHODS:
+            return None
+    elif status not in (429, 503) and not (status == 403 and "Retry-After" in resp.headers):
+        return None
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        # Don't park a tool call for minutes; surface long waits as errors instead
+        return float(retry_after) if int(retry_after) <= 60 else None
+    return random.uniform(0, min(30.0, 2.0 ** attempt))
+
+# Client-side rate governor: stay under GitHub's REST budget (5000/h, ~80/min)
+# and, once X-RateLimit-Remaining runs low, spread what's left until the reset
+RATE_LIMITER = AsyncLimiter(int(os.getenv("GITHUB_RATE_LIMIT_PER_MINUTE", "80")), 60)
+RATE_LIMIT_LOW_WATER = 50
+RATE_STATS = {"requests": 0, "rate_limited": 0, "throttled": 0}
+rate_limit_resume_at = 0.0  # monotonic time before which new requests wait
+
+def note_rate_limit(resp: httpx.Response):
+    global rate_limit_resume_at
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    reset = resp.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None or int(remaining) > RATE_LIMIT_LOW_WATER:
+        return
+    pause = min(60.0, max(0.0, float(reset) - time.time()) / (int(remaining) + 1))
+    rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + pause)
+    RATE_STATS["throttled"] += 1
+
+async def send_with_retry(request: httpx.Request) -> httpx.Response:
+    for attempt in range(MAX_RETRIES + 1):
+        wait = rate_limit_resume_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with RATE_LIMITER:
+            resp = await HTTP.send(request)
+        RATE_STATS["requests"] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s -> %s (%s)", request.method, request.url, resp.status_code, resp.http_version)
+        if resp.status_code == 429:
+            RATE_STATS["rate_limited"] += 1
+        note_rate_limit(resp)
+        delay = retry_delay(resp, attempt)
+        if delay is None or attempt == MAX_RETRIES:
+            return resp
+        logger.warning("GitHub %s %s returned %s, retrying in %.1fs", request.method, request.url, resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+# GET response cache keyed by credentials + URL. Entries are [fetched_at, etag, body, size]; stale
+# entries are kept (up to an hour) so they can be revalidated with If-None-Match.
+# Freshness is judged against each call's own cache_ttl, so cache_ttl=0 always
+# goes upstream (as a cheap conditional GET when an ETag is cached).
+CACHE_TTL = 60
+# Bounded by response bytes, not entry count, since contents and list payloads
+# can be large. Responses over a sixteenth of the budget aren't cached.
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE = TTLCache(maxsize=CACHE_MAX_BYTES, ttl=3600, getsizeof=lambda entry: entry[-1])
+
+def expire_cache():
+    """Mark every cached GET stale so reads after a write are revalidated."""
+    for entry in CACHE.values():
+        entry[0] = float("-inf")
 
-def github_request(method: str, url: str, user: Optional[str] = None, **kwargs):
-    resp = requests.request(method, url, headers=get_auth_header(user), **kwargs)
-    if not resp.ok:
+async def github_request(method: str, path: str, user: Optional[str] = None, cache_ttl: int = CACHE_TTL, **kwargs):
+    headers = {**get_auth_header(user), **kwargs.pop("headers", {})}
+    request = HTTP.build_request(method, path, headers=headers, **kwargs)
+    key = (request.headers["Authorization"], str(request.url))
+    cached = CACHE.get(key) if method == "GET" else None
+    if cached:
+        if time.monotonic() - cached[0] < cache_ttl:
+            return cached[2]
+        if cached[1]:
+            request.headers["If-None-Match"] = cached[1]
+    resp = await send_with_retry(request)
+    if resp.status_code == 304 and cached:
+        cached[0] = time.monotonic()
+        CACHE[key] = cached
+        return cached[2]
+    if not resp.is_success:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json() if resp.text else {}
+    body = orjson.loads(resp.content) if resp.content else {}
+    if method != "GET":
+        expire_cache()
+    elif "no-store" not in resp.headers.get("Cache-Control", "") and len(resp.content) <= CACHE_MAX_BYTES // 16:
+        CACHE[key] = [time.monotonic(), resp.headers.get("ETag"), body, len(resp.content)]
+    return body
 
-def check_readonly(request: Request):
-    if request.headers.get("X-MCP-Readonly", "").lower() == "true":
+async def github_paginate(path: str, params: Dict, user: Optional[str] = None, max_pages: int = 10, updated_since: Optional[str] = None) -> List[Dict]:
+    """
+    GET every page of a list endpoint (up to max_pages of 100 items). Page 1
+    reveals the last page via its Link header; the rest are fetched concurrently.
+    Every page bypasses the response cache so one listing is never stitched
+    together from snapshots of different ages.
+    With updated_since (ISO 8601, for listings sorted by updated desc), pages are
+    fetched in order, only items updated since then are kept, and paging stops at
+    the first page that reaches back past it.
+    """
+    params = {**params, "per_page": 100}
+
+    async def fetch_page(page: int) -> httpx.Response:
+        resp = await send_with_retry(HTTP.build_request("GET", path, headers=get_auth_header(user), params={**params, "page": page}))
+        if not resp.is_success:
+            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+        return resp
+
+    if updated_since:
+        items = []
+        for page in range(1, max_pages + 1):
+            batch = orjson.loads((await fetch_page(page)).content)
+            items.extend(item for item in batch if item["updated_at"] >= updated_since)
+            if len(batch) < 100 or batch[-1]["updated_at"] < updated_since:
+                break
+        return items
+    resp = await fetch_page(1)
+    items = orjson.loads(resp.content)
+    last = resp.links.get("last", {}).get("url")
+    if last:
+        last_page = min(int(httpx.URL(last).params.get("page", "1")), max_pages)
+        pages = await asyncio.gather(*(fetch_page(page) for page in range(2, last_page + 1)))
+        for page in pages:
+            items.extend(orjson.loads(page.content))
+    return items
+
+# Set once per HTTP request by ReadonlyMiddleware and read by the write tools
+READONLY: ContextVar[bool] = ContextVar("readonly", default=False)
+
+class ReadonlyMiddleware:
+    """Evaluate the X-MCP-Readonly header once per request, before any tool runs."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            READONLY.set(Headers(scope=scope).get("x-mcp-readonly", "").lower() == "true")
+        await self.app(scope, receive, send)
+
+def check_readonly():
+    """Raise if MCP client requested readonly mode."""
+    if READONLY.get():
         raise HTTPException(status_code=403, detail="Readonly mode enforced")
 
 # --------------------------------------------------------------------
 # OAuth Routes
 # --------------------------------------------------------------------
-oauth_app = FastAPI()
+oauth_router = APIRouter()
 
-@oauth_app.get("/login")
+@oauth_router.get("/login")
 def login():
     return RedirectResponse(
         f"https://github.com/login/oauth/authorize"
@@ -64,9 +241,9 @@ def login():
         f"&scope=repo read:user"
     )
 
-@oauth_app.get("/callback")
-def callback(code: str):
-    resp = requests.post(
+@oauth_router.get("/callback")
+async def callback(code: str):
+    resp = await HTTP.post(
         "https://github.com/login/oauth/access_token",
         headers={"Accept": "application/json"},
         data={
@@ -82,9 +259,9 @@ def callback(code: str):
     user_tokens["demo_user"] = token
     return JSONResponse({"access_token": token})
 
-@oauth_app.get("/me")
-def me():
-    return github_request("GET", f"{BASE_URL}/user", user="demo_user")
+@oauth_router.get("/me")
+async def me():
+    return await github_request("GET", "/user", user="demo_user")
 
 # --------------------------------------------------------------------
 # MCP Server
@@ -94,67 +271,82 @@ mcp = FastMCP("GitHubMCPServer", stateless_http=True, json_response=True)
 # === Your existing tools (adapted to support per-user) ===
 
 @mcp.tool()
-def create_branch(owner: str, repo: str, new_branch: str, base_branch: str = "main", user: str = None, request: Request = None) -> Dict:
-    check_readonly(request)
-    ref_url = f"{BASE_URL}/repos/{owner}/{repo}/git/ref/heads/{base_branch}"
-    ref_data = github_request("GET", ref_url, user)
+async def create_branch(owner: str, repo: str, new_branch: str, base_branch: str = "main", user: str = None) -> Dict:
+    check_readonly()
+    ref_url = f"/repos/{owner}/{repo}/git/ref/heads/{base_branch}"
+    ref_data = await github_request("GET", ref_url, user, cache_ttl=0)
     sha = ref_data["object"]["sha"]
-    create_url = f"{BASE_URL}/repos/{owner}/{repo}/git/refs"
-    resp = github_request("POST", create_url, user, json={"ref": f"refs/heads/{new_branch}", "sha": sha})
+    create_url = f"/repos/{owner}/{repo}/git/refs"
+    resp = await github_request("POST", create_url, user, json={"ref": f"refs/heads/{new_branch}", "sha": sha})
     return {"message": f"Branch '{new_branch}' created", "ref": resp}
 
 @mcp.tool()
-def create_or_update_file(owner: str, repo: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None, user: str = None, request: Request = None) -> Dict:
-    check_readonly(request)
-    encoded = base64.b64encode(content.encode()).decode()
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{path}"
-    payload = {"message": message, "content": encoded, "branch": branch}
+async def create_or_update_file(owner: str, repo: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None, user: str = None) -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/contents/{path}"
+    payload = {"message": message, "branch": branch}
     if sha: payload["sha"] = sha
-    resp = github_request("PUT", url, user, json=payload)
+    # Base64 output is JSON-safe, so splice the encoded bytes straight into the body
+    encoded = base64.b64encode(content.encode("utf-8"))
+    data = orjson.dumps(payload)[:-1] + b',"content":"' + encoded + b'"}'
+    resp = await github_request("PUT", url, user, content=data, headers={"Content-Type": "application/json"})
     return {"message": f"File '{path}' updated", "commit": resp.get("commit")}
 
 @mcp.tool()
-def get_contents(owner: str, repo: str, path: str, ref: str = "main", user: str = None) -> Dict:
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{path}?ref={ref}"
-    return github_request("GET", url, user)
+async def get_contents(owner: str, repo: str, path: str, ref: str = "main", user: str = None, cache_ttl: int = CACHE_TTL) -> Dict:
+    url = f"/repos/{owner}/{repo}/contents/{path}?ref={ref}"
+    return await github_request("GET", url, user, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def create_pull_request(owner: str, repo: str, title: str, head: str, base: str = "main", body: str = "", user: str = None, request: Request = None) -> Dict:
-    check_readonly(request)
-    url = f"{BASE_URL}/repos/{owner}/{repo}/pulls"
-    resp = github_request("POST", url, user, json={"title": title, "head": head, "base": base, "body": body})
+async def create_pull_request(owner: str, repo: str, title: str, head: str, base: str = "main", body: str = "", user: str = None) -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/pulls"
+    resp = await github_request("POST", url, user, json={"title": title, "head": head, "base": base, "body": body})
     return {"message": "PR created", "url": resp.get("html_url"), "number": resp.get("number")}
 
 @mcp.tool()
-def merge_pull_request(owner: str, repo: str, pr_number: int, commit_message: str = "Merging via MCP", user: str = None, request: Request = None) -> Dict:
-    check_readonly(request)
-    url = f"{BASE_URL}/repos/{owner}/{repo}/pulls/{pr_number}/merge"
-    resp = github_request("PUT", url, user, json={"commit_message": commit_message})
+async def merge_pull_request(owner: str, repo: str, pr_number: int, commit_message: str = "Merging via MCP", user: str = None) -> Dict:
+    check_readonly()
+    url = f"/repos/{owner}/{repo}/pulls/{pr_number}/merge"
+    resp = await github_request("PUT", url, user, json={"commit_message": commit_message})
     return {"message": f"PR #{pr_number} merged", "sha": resp.get("sha")}
 
 # === Conversational tools (new) ===
 
+# Keyword router for query_github: one case-insensitive pass, then a dict lookup
+QUERY_ROUTER = re.compile(r"(?P<pull>pull)|(?P<issue>issue)|(?P<release>release)", re.IGNORECASE)
+QUERY_ROUTES = {
+    "pull": "/repos/org/repo/pulls?state=open",
+    "issue": "/repos/org/repo/issues?state=open",
+    "release": "/repos/org/repo/releases",
+}
+
 @mcp.tool()
-def query_github(query: str, user: str = "demo_user") -> Dict:
-    if "pull" in query.lower():
-        return github_request("GET", "/repos/org/repo/pulls?state=open", user)
-    if "issue" in query.lower():
-        return github_request("GET", "/repos/org/repo/issues?state=open", user)
-    if "release" in query.lower():
-        return github_request("GET", "/repos/org/repo/releases", user)
-    return {"message": f"Query not understood: {query}"}
+async def query_github(query: str, user: str = "demo_user", cache_ttl: int = CACHE_TTL) -> Dict:
+    match = QUERY_ROUTER.search(query)
+    if not match:
+        return {"message": f"Query not understood: {query}"}
+    return await github_request("GET", QUERY_ROUTES[match.lastgroup], user, cache_ttl=cache_ttl)
 
 @mcp.tool()
-def weekly_digest(user: str = "demo_user") -> Dict:
-    since = (datetime.datetime.utcnow() - datetime.timedelta(days=7)).isoformat() + "Z"
-    prs = github_request("GET", f"/repos/org/repo/pulls?state=all&sort=updated&direction=desc", user)
-    issues = github_request("GET", f"/repos/org/repo/issues?since={since}", user)
-    md = "# Weekly Digest\n\n"
-    md += "## Pull Requests\n"
-    md += "\n".join([f"- {pr['title']} (#{pr['number']})" for pr in prs]) or "No PRs\n"
-    md += "\n\n## Issues\n"
-    md += "\n".join([f"- {issue['title']} (#{issue['number']})" for issue in issues]) or "No issues\n"
-    return {"digest": md}
+async def weekly_digest(user: str = "demo_user") -> Dict:
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=7)).replace(microsecond=0).isoformat() + "Z"
+    prs, issues = await asyncio.gather(
+        github_paginate("/repos/org/repo/pulls", {"state": "all", "sort": "updated", "direction": "desc"}, user, updated_since=since),
+        github_paginate("/repos/org/repo/issues", {"since": since}, user),
+    )
+    buf = io.StringIO()
+    buf.write("# Weekly Digest\n\n## Pull Requests\n")
+    if prs:
+        buf.writelines(f"- {pr['title']} (#{pr['number']})\n" for pr in prs)
+    else:
+        buf.write("No PRs\n")
+    buf.write("\n## Issues\n")
+    if issues:
+        buf.writelines(f"- {issue['title']} (#{issue['number']})\n" for issue in issues)
+    else:
+        buf.write("No issues\n")
+    return {"digest": buf.getvalue()}
 
 # --------------------------------------------------------------------
 # FastAPI + Lifespan
@@ -165,14 +357,23 @@ mcp_app = mcp.streamable_http_app()
 async def lifespan(_: FastAPI):
     async with contextlib.AsyncExitStack() as stack:
         await stack.enter_async_context(mcp.session_manager.run())
+        # Release pooled connections on shutdown
+        stack.push_async_callback(HTTP.aclose)
         yield
 
 main_app = FastAPI(lifespan=lifespan)
+main_app.add_middleware(ReadonlyMiddleware)
+main_app.include_router(oauth_router)
 
 @main_app.get("/healthz")
 def healthz():
     return {"status": "ok"}
 
-# Mount both
-main_app.mount("/mcp", mcp_app)
-main_app.mount("/", oauth_app)
+@main_app.get("/metrics")
+def metrics():
+    """Upstream request counters, for watching the 429 rate."""
+    return RATE_STATS
+
+# Serve the MCP endpoint (/mcp) from this app's router rather than a mounted
+# sub-app, so requests resolve in a single routing pass
+main_app.router.routes.extend(mcp_app.routes)
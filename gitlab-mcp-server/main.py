@@ -1,18 +1,36 @@
 import os
+import asyncio
+import re
+import time
+import random
 import base64
-import requests
+import functools
+import httpx
+import orjson
+from cachetools import TLRUCache
+from importlib.util import find_spec
+from urllib.parse import quote
 from typing import List, Dict, Optional
-import logging as logger
-from fastapi import FastAPI, Request, HTTPException
+from typing_extensions import NotRequired, TypedDict
+import logging
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
 from contextlib import asynccontextmanager
 import contextlib
+from contextvars import ContextVar
 
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 
 # --------------------------------------------------------------------
 # Logging setup
 # --------------------------------------------------------------------
-logger.basicConfig(level=logger.INFO)
+logging.basicConfig(level=logging.INFO)
+# httpx logs every request at INFO; keep it to warnings
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # --------------------------------------------------------------------
 # GitLab client helper
@@ -24,92 +42,337 @@ if not GITLAB_TOKEN:
 # Example: https://code.lioncloud.net/api/v4
 GITLAB_BASE_URL = os.getenv("GITLAB_BASE_URL", "https://code.lioncloud.net/api/v4")
 
+# GraphQL lives beside the REST API, e.g. https://code.lioncloud.net/api/graphql
+GITLAB_GRAPHQL_URL = os.getenv("GITLAB_GRAPHQL_URL", GITLAB_BASE_URL.rsplit("/v4", 1)[0] + "/graphql")
+
 HEADERS = {
     "PRIVATE-TOKEN": GITLAB_TOKEN,
     "Accept": "application/json"
 }
 
-def gitlab_request(method: str, url: str, **kwargs):
-    resp = requests.request(method, url, headers=HEADERS, **kwargs)
-    if not resp.ok:
-        raise RuntimeError(f"GitLab API error {resp.status_code}: {resp.text}")
-    return resp.json() if resp.text else {}
+# HTTP/2 lets concurrent calls multiplex over one connection; it needs the h2
+# package (httpx[http2]), so fall back to HTTP/1.1 keep-alive without it
+HTTP2 = find_spec("h2") is not None
+
+# Shared async client: keep-alive/HTTP2 connections are reused across tool calls
+# Default headers live on the client (and in the HPACK table on HTTP/2)
+# instead of being merged into every request
+HTTP = httpx.AsyncClient(
+    base_url=GITLAB_BASE_URL,
+    headers=HEADERS,
+    # retries= re-attempts failed connects only; HTTP-level retries are in gitlab_send
+    transport=httpx.AsyncHTTPTransport(
+        http2=HTTP2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
+        retries=3,
+    ),
+    timeout=30.0,
+)
+
+MAX_RETRIES = 3
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+def retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying `resp`, or None if it shouldn't be retried.
+    Honors Retry-After, otherwise exponential backoff with full jitter (base 1s, cap 30s).
+    A 502/504 may hide a completed write, so those are only retried for idempotent methods.
+    """
+    status = resp.status_code
+    if status in (502, 504):
+        if resp.request.method not in IDEMPOTENT_METHODS:
+            return None
+    elif status not in (429, 503):
+        return None
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        # Don't park a tool call for minutes; surface long waits as errors instead
+        return float(retry_after) if int(retry_after) <= 60 else None
+    return random.uniform(0, min(30.0, 2.0 ** attempt))
+
+# Circuit breaker: after BREAKER_THRESHOLD consecutive 5xx/transport failures,
+# fail fast for BREAKER_COOLDOWN seconds instead of piling more load on GitLab
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 10.0
+breaker = {"failures": 0, "open_until": 0.0}
+
+def record_outcome(failed: bool):
+    if not failed:
+        breaker["failures"] = 0
+        return
+    breaker["failures"] += 1
+    if breaker["failures"] >= BREAKER_THRESHOLD:
+        breaker["open_until"] = time.monotonic() + BREAKER_COOLDOWN
+        breaker["failures"] = 0
+
+class GitLabAPIError(RuntimeError):
+    def __init__(self, status_code: int, detail):
+        super().__init__(f"GitLab API error {status_code}: {detail}")
+        self.status_code = status_code
+
+async def gitlab_send(method: str, url: str, **kwargs) -> httpx.Response:
+    if "json" in kwargs:
+        # orjson encodes request bodies much faster than httpx's stdlib json
+        kwargs["content"] = orjson.dumps(kwargs.pop("json"))
+        kwargs["headers"] = {**kwargs.get("headers", {}), "Content-Type": "application/json"}
+    if time.monotonic() < breaker["open_until"]:
+        raise RuntimeError("GitLab circuit open after repeated server errors; try again shortly")
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            resp = await HTTP.request(method, url, **kwargs)
+        except httpx.TransportError:
+            record_outcome(True)
+            raise
+        record_outcome(resp.status_code >= 500)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s -> %s (%s)", method, url, resp.status_code, resp.http_version)
+        delay = retry_delay(resp, attempt)
+        if delay is None or attempt == MAX_RETRIES:
+            break
+        logger.warning("GitLab %s %s returned %s, retrying in %.1fs", method, url, resp.status_code, delay)
+        await asyncio.sleep(delay)
+    if not resp.is_success:
+        logger.error("GitLab %s %s -> %s", method, url, resp.status_code)
+        raise GitLabAPIError(resp.status_code, resp.text)
+    return resp
+
+async def gitlab_request(method: str, url: str, **kwargs):
+    resp = await gitlab_send(method, url, **kwargs)
+    return orjson.loads(resp.content) if resp.content else {}
+
+# get_contents cache: entries are (ttl, parsed body), expiring ttl seconds after insert.
+# Refs that look like commit SHAs get a long TTL, but only a long finite one: an
+# all-hex branch or tag name (e.g. "cafe123") matches too. Other refs follow
+# Cache-Control max-age.
+SHA_REF = re.compile(r"^[0-9a-f]{7,40}$")
+SHA_REF_TTL = 3600
+MAX_AGE = re.compile(r"max-age=(\d+)")
+CONTENTS_TTL = 60
+CONTENTS_CACHE = TLRUCache(maxsize=1024, ttu=lambda _key, value, now: now + value[0])
+
+# Concurrent get_contents calls for the same key share one upstream request
+CONTENTS_INFLIGHT: Dict[tuple, asyncio.Task] = {}
+
+@functools.lru_cache(maxsize=4096)
+def quote_path(path: str) -> str:
+    """URL-encode a repository file path (slashes included) for the files API."""
+    return quote(path, safe="")
+
+def expire_contents(project_id: str, branch: Optional[str] = None):
+    """Drop cached get_contents results for a branch (or every ref) after this server writes to it."""
+    for key in list(CONTENTS_CACHE):
+        if key[0] == project_id and (branch is None or key[2] == branch):
+            CONTENTS_CACHE.pop(key, None)
+
+def contents_ttl(ref: str, cache_control: str) -> float:
+    if SHA_REF.match(ref):
+        return SHA_REF_TTL
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    m = MAX_AGE.search(cache_control)
+    return int(m.group(1)) if m else CONTENTS_TTL
+
+async def gitlab_graphql(query: str, variables: Dict):
+    """Run a GraphQL query so several resources come back in one round-trip."""
+    resp = await gitlab_request(
+        "POST", GITLAB_GRAPHQL_URL, json={"query": query, "variables": variables},
+        headers={"Authorization": f"Bearer {GITLAB_TOKEN}"},
+    )
+    if resp.get("errors"):
+        raise RuntimeError(f"GitLab GraphQL error: {resp['errors']}")
+    return resp.get("data") or {}
 
-def check_readonly(request: Request):
+# Set once per HTTP request by ReadonlyMiddleware and read by the write tools
+READONLY: ContextVar[bool] = ContextVar("readonly", default=False)
+# Header values that turn readonly mode on, matched without allocating a lowered copy
+READONLY_VALUES = frozenset({"true", "True", "TRUE", "1", "yes"})
+
+class ReadonlyMiddleware:
+    """Evaluate the X-MCP-Readonly header once per request, before any tool runs."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            READONLY.set(Headers(scope=scope).get("x-mcp-readonly", "") in READONLY_VALUES)
+        await self.app(scope, receive, send)
+
+def check_readonly():
     """Raise if MCP client requested readonly mode."""
-    if request.headers.get("X-MCP-Readonly", "").lower() == "true":
+    if READONLY.get():
         raise HTTPException(status_code=403, detail="Readonly mode enforced")
 
 # --------------------------------------------------------------------
 # MCP server
 # --------------------------------------------------------------------
-mcp = FastMCP("GitLabMCPServer", stateless_http=True, json_response=True)
+# json_response=False answers over an SSE stream, so progress notifications
+# reach the client while a tool is still running
+mcp = FastMCP("GitLabMCPServer", stateless_http=True, json_response=False)
 
 # --------------------------------------------------------------------
 # Tools
 # --------------------------------------------------------------------
 @mcp.tool()
-def create_branch(project_id: str, new_branch: str, base_branch: str = "main" ) -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/repository/branches"
-    resp = gitlab_request("POST", url, json={"branch": new_branch, "ref": base_branch})
+async def create_branch(project_id: str, new_branch: str, base_branch: str = "main" ) -> Dict:
+    check_readonly()
+    url = f"/projects/{project_id}/repository/branches"
+    resp = await gitlab_request("POST", url, json={"branch": new_branch, "ref": base_branch})
     return {"message": f"Branch '{new_branch}' created", "branch": resp}
 
 @mcp.tool()
-def create_or_update_file(project_id: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None ) -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/repository/files/{requests.utils.quote(path, safe='')}"
+async def create_or_update_file(project_id: str, branch: str, path: str, content: str, message: str, sha: Optional[str] = None ) -> Dict:
+    check_readonly()
+    url = f"/projects/{project_id}/repository/files/{quote_path(path)}"
     payload = {
         "branch": branch,
         "content": content,
         "commit_message": message
     }
     method = "PUT" if sha else "POST"
-    resp = gitlab_request(method, url, json=payload)
+    resp = await gitlab_request(method, url, json=payload)
+    expire_contents(project_id, branch)
     return {"message": f"File '{path}' updated", "response": resp}
 
+async def fetch_contents(key: tuple) -> Dict:
+    project_id, path, ref = key
+    try:
+        url = f"/projects/{project_id}/repository/files/{quote_path(path)}"
+        resp = await gitlab_send("GET", url, params={"ref": ref})
+        data = orjson.loads(resp.content)
+        ttl = contents_ttl(ref, resp.headers.get("Cache-Control", ""))
+        if ttl > 0:
+            CONTENTS_CACHE[key] = (ttl, data)
+        return data
+    finally:
+        del CONTENTS_INFLIGHT[key]
+
+@mcp.tool()
+async def get_contents(project_id: str, path: str, ref: str = "main") -> Dict:
+    key = (project_id, path, ref)
+    cached = CONTENTS_CACHE.get(key)
+    if cached is not None:
+        return cached[1]
+    task = CONTENTS_INFLIGHT.get(key)
+    if task is None:
+        # The fetch runs as its own task so it outlives any one caller
+        task = CONTENTS_INFLIGHT[key] = asyncio.ensure_future(fetch_contents(key))
+        # Retrieve the outcome even if every caller went away, so a failure isn't logged as unhandled
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    # shield: a cancelled caller (including the first) leaves the fetch running for the others
+    return await asyncio.shield(task)
+
+FILE_WITH_CONTEXT_QUERY = """
+query($fullPath: ID!, $path: String!, $ref: String!) {
+  project(fullPath: $fullPath) {
+    repository {
+      rootRef
+      blobs(paths: [$path], ref: $ref) { nodes { path size rawTextBlob } }
+      tree(ref: $ref) { lastCommit { sha title authoredDate } }
+    }
+  }
+}
+"""
+
 @mcp.tool()
-def get_contents(project_id: str, path: str, ref: str = "main") -> Dict:
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/repository/files/{requests.utils.quote(path, safe='')}?ref={ref}"
-    return gitlab_request("GET", url)
+async def get_file_with_context(project_path: str, path: str, ref: str = "main") -> Dict:
+    """Fetch a file, the latest commit on ref and the default branch in one GraphQL query.
+
+    project_path is the full namespace path (e.g. "group/project"), not the numeric ID.
+    """
+    data = await gitlab_graphql(FILE_WITH_CONTEXT_QUERY, {"fullPath": project_path, "path": path, "ref": ref})
+    repo = (data.get("project") or {}).get("repository") or {}
+    blobs = (repo.get("blobs") or {}).get("nodes") or []
+    return {
+        "file": blobs[0] if blobs else None,
+        "last_commit": (repo.get("tree") or {}).get("lastCommit"),
+        "default_branch": repo.get("rootRef"),
+    }
 
 @mcp.tool()
-def create_merge_request(project_id: str, title: str, source_branch: str, target_branch: str = "main", description: str = "") -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/merge_requests"
+async def create_merge_request(project_id: str, title: str, source_branch: str, target_branch: str = "main", description: str = "") -> Dict:
+    check_readonly()
+    url = f"/projects/{project_id}/merge_requests"
     payload = {
         "title": title,
         "source_branch": source_branch,
         "target_branch": target_branch,
         "description": description
     }
-    resp = gitlab_request("POST", url, json=payload)
+    resp = await gitlab_request("POST", url, json=payload)
     return {"message": "Merge request created", "url": resp.get("web_url"), "iid": resp.get("iid")}
 
 @mcp.tool()
-def merge_merge_request(project_id: str, mr_iid: int, merge_commit_message: str = "Merging via MCP" ) -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/merge_requests/{mr_iid}/merge"
-    resp = gitlab_request("PUT", url, json={"merge_commit_message": merge_commit_message})
+async def merge_merge_request(project_id: str, mr_iid: int, merge_commit_message: str = "Merging via MCP" ) -> Dict:
+    check_readonly()
+    url = f"/projects/{project_id}/merge_requests/{mr_iid}/merge"
+    resp = await gitlab_request("PUT", url, json={"merge_commit_message": merge_commit_message})
+    expire_contents(project_id, resp.get("target_branch"))
     return {"message": f"MR !{mr_iid} merged", "sha": resp.get("sha")}
 
+class FileSpec(TypedDict):
+    """One file for push_multiple_files; sha marks an existing file to update rather than create."""
+    path: str
+    content: str
+    sha: NotRequired[str]
+
 @mcp.tool()
-def push_multiple_files(project_id: str, branch: str, files: List[Dict[str, str]], message: str ) -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/repository/commits"
-    actions = [
-        {"action": "create", "file_path": f["path"], "content": f["content"]}
-        for f in files
-    ]
-    payload = {"branch": branch, "commit_message": message, "actions": actions}
-    resp = gitlab_request("POST", url, json=payload)
+async def push_multiple_files(project_id: str, branch: str, files: List[FileSpec], message: str, ctx: Context, per_file_fallback: bool = False) -> Dict:
+    """
+    Commit all files to branch in one atomic commit.
+    If GitLab rejects the batch and per_file_fallback is set, the files are
+    instead written one commit each; any failure there is raised as an error
+    naming the files that were already committed.
+    """
+    check_readonly()
+    url = f"/projects/{project_id}/repository/commits"
+    # Turn each file into a commit action in place so large contents are not
+    # referenced from a second list; gitlab_send then encodes the whole payload
+    # in a single orjson pass
+    for f in files:
+        f["action"] = "update" if f.pop("sha", None) else "create"
+        f["file_path"] = f.pop("path")
+    payload = {"branch": branch, "commit_message": message, "actions": files}
+    try:
+        resp = await gitlab_request("POST", url, json=payload)
+        expire_contents(project_id, branch)
+    except GitLabAPIError as e:
+        # A 400 means GitLab rejected an action (e.g. a create for a file that
+        # already exists) and committed nothing. Any other failure may mean the
+        # commit landed or the branch is unusable, so it's never replayed per file.
+        if e.status_code != 400 or not per_file_fallback:
+            raise
+        # Each Files API write is its own commit on the branch; run them one at a
+        # time so they don't race on the branch head, and stop at the first failure
+        committed = []
+        for f in files:
+            try:
+                await write_file(project_id, branch, f, message)
+            except Exception as err:
+                raise RuntimeError(
+                    f"Batch commit rejected ({e}); per-file fallback failed on "
+                    f"'{f['file_path']}' ({err}) after committing {committed or 'nothing'}"
+                ) from err
+            committed.append(f["file_path"])
+            await ctx.report_progress(len(committed), len(files))
+        return {"message": f"Committed {len(files)} files individually", "commit_error": str(e), "files": committed}
     return {"message": f"Committed {len(files)} files", "commit": resp}
 
+async def write_file(project_id: str, branch: str, f: Dict[str, str], message: str) -> Dict:
+    """Apply one commit action (create or update, as declared) through the Files API."""
+    url = f"/projects/{project_id}/repository/files/{quote_path(f['file_path'])}"
+    payload = {"branch": branch, "content": f["content"], "commit_message": message}
+    method = "PUT" if f["action"] == "update" else "POST"
+    resp = await gitlab_request(method, url, json=payload)
+    expire_contents(project_id, branch)
+    return resp
+
 @mcp.tool()
-def update_mr_branch(project_id: str, mr_iid: int ) -> Dict:
-    check_readonly(request)
-    url = f"{GITLAB_BASE_URL}/projects/{project_id}/merge_requests/{mr_iid}/rebase"
-    resp = gitlab_request("PUT", url)
+async def update_mr_branch(project_id: str, mr_iid: int ) -> Dict:
+    check_readonly()
+    url = f"/projects/{project_id}/merge_requests/{mr_iid}/rebase"
+    resp = await gitlab_request("PUT", url)
+    # The rebase response doesn't name the source branch, so expire every ref in the project
+    expire_contents(project_id)
     return {"message": f"MR !{mr_iid} rebase requested", "response": resp}
 
 # --------------------------------------------------------------------
@@ -121,13 +384,31 @@ mcp_app = mcp.streamable_http_app()
 async def lifespan(_: FastAPI):
     async with contextlib.AsyncExitStack() as stack:
         await stack.enter_async_context(mcp.session_manager.run())
+        # Release pooled connections on shutdown
+        stack.push_async_callback(HTTP.aclose)
         yield
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ReadonlyMiddleware)
 
 @app.get("/healthz")
-def healthz():
+def healthz() -> Dict[str, str]:
     return {"status": "ok"}
 
+@app.get("/raw")
+async def raw_file(project_id: str, path: str, ref: str = "main"):
+    """Stream a file's raw bytes in 64 KiB chunks rather than buffering a base64 JSON envelope."""
+    req = HTTP.build_request("GET", f"/projects/{project_id}/repository/files/{quote_path(path)}/raw", params={"ref": ref})
+    resp = await HTTP.send(req, stream=True)
+    if not resp.is_success:
+        detail = await resp.aread()
+        await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=detail.decode(errors="replace"))
+    return StreamingResponse(
+        resp.aiter_bytes(65536),
+        media_type=resp.headers.get("Content-Type", "application/octet-stream"),
+        background=BackgroundTask(resp.aclose),
+    )
+
 # Mount MCP server at "/"
 app.mount("/", mcp_app)